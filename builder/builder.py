@@ -7,6 +7,9 @@ import os
 import json
 
 from asyncio.subprocess import create_subprocess_shell, PIPE, STDOUT
+from hashlib import sha256
+from re import MULTILINE, match as re_match, search as re_search, sub as re_sub
+from shutil import which
 from tempfile import TemporaryDirectory
 from tornado.ioloop import IOLoop
 from tornado.web import Application, HTTPError, RequestHandler
@@ -16,8 +19,75 @@ BUILDER_PACKAGE_DIR = './plugins/package'
 TARGET_PLATFORM = os.getenv('MCB_BUILDER_TARGET', 'moddwarf-new')
 WORKDIR = os.getenv('WORKDIR', os.path.expanduser('~/mod-workdir'))
 
+# local checkouts of git based packages, reused across builds instead of cloning each time
+SKELETON_DIR = os.getenv('MCB_BUILDER_SKELETON_DIR', os.path.expanduser('~/skeletons'))
+
+# only the skeletons generated by the webserver are cached, keyed by their full site url
+SKELETON_SITES = {
+    'https://github.com/mod-audio/faust-skeleton.git': 'faust-skeleton',
+    'https://github.com/mod-audio/max-gen-skeleton.git': 'max-gen-skeleton',
+    'https://github.com/Wasted-Audio/hvcc.git': 'hvcc',
+}
+
+# compression used for the final bundle archive, gzip is what MOD units expect
+COMPRESSION = os.getenv('MCB_BUILDER_COMPRESSION', 'gzip')
+
+COMPRESSORS = {
+    'gzip': ('.tar.gz', 'pigz' if which('pigz') else 'gzip'),
+    'zstd': ('.tar.zst', 'zstd -T0 -q'),
+}
+
+if COMPRESSION not in COMPRESSORS:
+    raise SystemExit(f'Invalid compression "{COMPRESSION}", must be one of: {", ".join(COMPRESSORS)}')
+
 os.environ['MPB_SKIP_PLUGIN_COPY'] = '1'
 
+class Skeleton(object):
+    pending = set()
+
+    @classmethod
+    def path(kls, site, version):
+        return os.path.join(SKELETON_DIR, f'{SKELETON_SITES[site]}-{version}')
+
+    @classmethod
+    async def fetch(kls, site, version):
+        path = kls.path(site, version)
+        if path in kls.pending or os.path.exists(path):
+            return
+
+        print("Skeleton.fetch", site, version)
+        kls.pending.add(path)
+        proc = await create_subprocess_shell(f'mkdir -p {SKELETON_DIR} && rm -rf {path}.tmp && '
+                                             f'git clone -q {site} {path}.tmp && '
+                                             f'git -C {path}.tmp checkout -q {version} && '
+                                             f'mv {path}.tmp {path}')
+        await proc.wait()
+        kls.pending.remove(path)
+
+    @classmethod
+    def apply(kls, package, pkgname):
+        # point git packages to a local checkout if we have one, fetch it for next time otherwise
+        method = re_search(rf'^{pkgname}_SITE_METHOD = (\S+)$', package, MULTILINE)
+        site = re_search(rf'^{pkgname}_SITE = (\S+)$', package, MULTILINE)
+        version = re_search(rf'^{pkgname}_VERSION = (\S+)$', package, MULTILINE)
+
+        if method is None or method.group(1) != 'git' or site is None or version is None:
+            return package
+
+        # branches and tags move, only full commit hashes are safe to reuse
+        if site.group(1) not in SKELETON_SITES or re_match(r'^[0-9a-f]{40}$', version.group(1)) is None:
+            return package
+
+        path = kls.path(site.group(1), version.group(1))
+
+        if not os.path.exists(path):
+            IOLoop.current().spawn_callback(kls.fetch, site.group(1), version.group(1))
+            return package
+
+        package = re_sub(rf'^{pkgname}_SITE_METHOD = git$', f'{pkgname}_SITE_METHOD = local', package, flags=MULTILINE)
+        package = re_sub(rf'^{pkgname}_SITE = \S+$', f'{pkgname}_SITE = {path}', package, flags=MULTILINE)
+        return package
+
 class Builder(object):
     active = {}
 
@@ -26,6 +96,9 @@ class Builder(object):
         self.projdir = TemporaryDirectory(dir=BUILDER_PACKAGE_DIR)
         self.projname = os.path.basename(self.projdir.name)
         self.pkgbundle = pkgbundle
+        self.archive = None
+        self.archive_size = 0
+        self.archive_sha256 = None
 
     async def build(self, write_message_callback):
         print("Builder.build", write_message_callback)
@@ -43,7 +116,9 @@ class Builder(object):
                 proc = self.proc
                 self.proc = None
                 returncode = await proc.wait()
-                if returncode == 0:
+                if returncode == 0 and not await self.pack():
+                    write_message_callback(u"Build completed but bundle could not be archived.")
+                elif returncode == 0:
                     write_message_callback(u"Build completed successfully.")
                 else:
                     write_message_callback(
@@ -52,6 +127,36 @@ class Builder(object):
                 break
             write_message_callback(stdout)
 
+    async def pack(self):
+        # archive the bundle once, so downloads can just send the file as-is
+        folders = (
+            os.path.join(BUILDER_PACKAGE_DIR, self.projname),
+            f"{WORKDIR}/{TARGET_PLATFORM}/target/usr/lib/lv2",
+        )
+
+        for folder in folders:
+            if os.path.exists(os.path.join(folder, self.pkgbundle)):
+                break
+        else:
+            return False
+
+        ext, compressor = COMPRESSORS[COMPRESSION]
+        archive = os.path.join(self.projdir.name, self.pkgbundle + ext)
+
+        proc = await create_subprocess_shell(f'tar -C {folder} -I "{compressor}" -chf {archive} {self.pkgbundle}')
+        if await proc.wait() != 0:
+            return False
+
+        digest = sha256()
+        with open(archive, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(65536), b''):
+                digest.update(chunk)
+
+        self.archive = archive
+        self.archive_size = os.path.getsize(archive)
+        self.archive_sha256 = digest.hexdigest()
+        return True
+
     def destroy(self):
         print("Builder.destroy")
         Builder.active.pop(self.projname)
@@ -107,6 +212,9 @@ class BuilderRequest(RequestHandler):
             self.postdone({ 'ok': False, 'error': "Multiple bundles per package is not supported" })
             return
 
+        # use local skeleton checkout when possible
+        package = Skeleton.apply(package, pkgname)
+
         # prepare for build
         builder = Builder.create(pkgbundle)
 
@@ -127,29 +235,23 @@ class BuilderRequest(RequestHandler):
         self.write(json.dumps(data))
         self.finish()
 
-    async def get(self):
+    def get(self):
         builder = Builder.get(self.jsonrequest['id'])
-        folders = (
-            os.path.join(BUILDER_PACKAGE_DIR, builder.projname),
-            f"{WORKDIR}/{TARGET_PLATFORM}/target/usr/lib/lv2",
-        )
 
-        for folder in folders:
-            if os.path.exists(os.path.join(folder, builder.pkgbundle)):
-                break
-        else:
+        if builder.archive is None:
             # No bundle found post-build
             self.write('')
             self.finish()
             return
 
-        proc = await create_subprocess_shell(f'tar -C {folder} -chz {builder.pkgbundle} -O', stdout=PIPE)
+        self.set_header('Content-Type', 'application/octet-stream')
+        self.set_header('Content-Length', str(builder.archive_size))
+        self.set_header('X-MCB-Compression', COMPRESSION)
+        self.set_header('X-MCB-SHA256', builder.archive_sha256)
 
-        while proc is not None:
-            stdout = await proc.stdout.read(8192)
-            if stdout == b'':
-                break
-            self.write(stdout)
+        with open(builder.archive, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(65536), b''):
+                self.write(chunk)
 
         self.finish()
 
@@ -4,23 +4,68 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
 # imports
+# patch blocking I/O first, so builder connections do not stall other requests
+from gevent import monkey
+monkey.patch_all()
+
 import os
 import sys
 import json
+import sqlite3
+import tarfile
 
 from base64 import encodebytes
-from flask import Flask, Response, copy_current_request_context, redirect, request, render_template, send_from_directory
+from contextlib import closing, contextmanager
+from fcntl import LOCK_EX, LOCK_UN, flock
+from flask import Flask, Response, redirect, request, render_template, send_file, send_from_directory
 from flask_socketio import SocketIO, emit, send
-from gevent import spawn
-from re import sub as re_sub
-from tempfile import mkdtemp
+from functools import lru_cache
+from gevent import sleep, spawn
+from gevent.event import Event
+from gevent.pywsgi import WSGIServer
+from geventwebsocket.handler import WebSocketHandler
+from gzip import GzipFile, compress as gzip_compress, decompress as gzip_decompress
+from hashlib import sha256
+from io import BytesIO
+from re import IGNORECASE, MULTILINE, compile as re_compile, escape as re_escape, finditer as re_finditer, match as re_match, search as re_search, sub as re_sub
+from shutil import rmtree, which
+from socketio import PubSubManager
+from subprocess import PIPE, STDOUT, CalledProcessError, TimeoutExpired, run
+from time import time
+from tempfile import TemporaryDirectory, TemporaryFile, mkdtemp
 from unicodedata import normalize
 from urllib.request import Request, urlopen
 from websocket import create_connection
+from zlib import error as zlib_error
+
+# optional, used for validating Pure Data patches before building
+try:
+    from hvcc.interpreters.pd2hv.pd2hv import pd2hv
+except ImportError:
+    pd2hv = None
 
 # configuration
 BUILDER_STORAGE = os.getenv('MOD_BUILDER_STORAGE', '/mnt/storage')
 
+# number of webserver processes, all sharing the same port
+WEBSERVER_WORKERS = int(os.getenv('MOD_BUILDER_WORKERS', 1))
+
+# socket.io message queue for relaying events between workers, redis://, amqp:// or sqlite://
+MESSAGE_QUEUE = os.getenv('MOD_BUILDER_MESSAGE_QUEUE',
+                          f'sqlite://{BUILDER_STORAGE}/messages.db' if WEBSERVER_WORKERS > 1 else None)
+
+# batch build job state, shared by all workers
+STATE_DB = os.getenv('MOD_BUILDER_STATE_DB', os.path.join(BUILDER_STORAGE, 'state.db'))
+
+# seconds between heartbeats of running jobs, and without one before a job is given to another worker
+JOB_HEARTBEAT_INTERVAL = 5
+JOB_HEARTBEAT_TIMEOUT = 60
+
+# days to keep stored builds for, 0 means forever
+BUILDER_STORAGE_RETENTION = int(os.getenv('MOD_BUILDER_STORAGE_RETENTION', 0))
+
+HEAVYLIB_DIR = os.getenv('MOD_HEAVYLIB_DIR', os.path.expanduser('~/heavylib'))
+
 MOD_UI_HTML_DIR = os.getenv('MOD_UI_HTML_DIR',
                             os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'mod-ui', 'html')))
 
@@ -75,11 +120,98 @@ targets = {
     'anagram': 'darkglass-anagram-builder:8004',
 }
 
+reqheaders = {
+  'Content-Type': 'application/json; charset=UTF-8',
+}
+
+# where batch build API results are kept
+API_STORAGE = os.path.join(BUILDER_STORAGE, 'api')
+
+# where build logs are kept, see BuildLog
+LOG_STORAGE = os.path.join(BUILDER_STORAGE, 'logs')
+LOG_CHUNK_LINES = 256
+LOG_ERROR_PATTERN = re_compile(r'error|failed|\*\*\*', IGNORECASE)
+
+# where the contents of persistent builds are kept, addressed by their sha256
+BLOB_STORAGE = os.path.join(BUILDER_STORAGE, 'blobs')
+
+# file extension for each builder archive compression
+archive_extensions = {
+    'gzip': '.tar.gz',
+    'zstd': '.tar.zst',
+}
+
+# socket.io message queue through sqlite, good enough for several workers on a single host
+# messages are stored as json, so everything emitted must be json serializable
+class SQLiteManager(PubSubManager):
+    name = 'sqlite'
+
+    def __init__(self, url, channel='socketio', write_only=False, logger=None):
+        self.path = url[len('sqlite://'):]
+        self.pending = []
+        self.publisher = None
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+
+        with closing(sqlite3.connect(self.path, timeout=30)) as db, db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS messages '
+                       '(id INTEGER PRIMARY KEY AUTOINCREMENT, channel TEXT, data TEXT, created REAL)')
+
+    def _publish(self, data):
+        # messages are written in batches by a single greenlet per worker, instead of a commit per emit
+        self.pending.append((self.channel, json.dumps(data), time()))
+
+        # started on first use, so each forked worker gets its own connection
+        if self.publisher is None:
+            self.wakeup = Event()
+            self.publisher = spawn(self._publisher)
+
+        self.wakeup.set()
+
+    def _publisher(self):
+        with closing(sqlite3.connect(self.path, timeout=30)) as db:
+            while True:
+                self.wakeup.wait()
+                self.wakeup.clear()
+
+                pending, self.pending = self.pending, []
+                try:
+                    with db:
+                        db.executemany('INSERT INTO messages (channel, data, created) VALUES (?, ?, ?)', pending)
+                except sqlite3.Error as e:
+                    print('failed to publish socket.io messages, retrying:', e)
+                    self.pending[:0] = pending
+                    self.wakeup.set()
+                    sleep(1)
+
+    def _listen(self):
+        with closing(sqlite3.connect(self.path, timeout=30)) as db:
+            last = db.execute('SELECT COALESCE(MAX(id), 0) FROM messages').fetchone()[0]
+            cleanup = time()
+
+            while True:
+                rows = db.execute('SELECT id, data FROM messages WHERE channel = ? AND id > ? ORDER BY id',
+                                  (self.channel, last)).fetchall()
+                for last, data in rows:
+                    yield json.loads(data)
+
+                # every worker has seen these by now
+                if time() - cleanup > 60:
+                    cleanup = time()
+                    with db:
+                        db.execute('DELETE FROM messages WHERE created < ?', (cleanup - 60,))
+
+                sleep(0.05)
+
 # setup
 app = Flask(__name__)
 # Disable caching?
 app.config['TEMPLATES_AUTO_RELOAD'] = True
-socketio = SocketIO(app, cors_allowed_origins="*")
+
+if MESSAGE_QUEUE is not None and MESSAGE_QUEUE.startswith('sqlite://'):
+    socketio = SocketIO(app, cors_allowed_origins="*", client_manager=SQLiteManager(MESSAGE_QUEUE))
+else:
+    socketio = SocketIO(app, cors_allowed_origins="*", message_queue=MESSAGE_QUEUE)
 
 def sanitize(name):
     if not name:
@@ -104,23 +236,10 @@ def symbolify(name):
         name = '_' + name
     return name
 
-@socketio.on('build')
-def build(msg):
-    print('build started')
-
+def create_package(msg):
     buildtype = msg.get('type', None)
     if buildtype is None or buildtype not in ('buildroot', 'faust', 'hvcc', 'maxgen'):
-        emit('buildlog', 'Invalid build target, cannot continue')
-        emit('status', 'error')
-        return
-
-    device = msg.get('device', None)
-    if device is None or device not in targets:
-        emit('buildlog', 'Invalid device target, cannot continue')
-        emit('status', 'error')
-        return
-
-    persistent = bool(msg.get('persistent', False))
+        return None, 'Invalid build target, cannot continue'
 
     if buildtype == 'buildroot':
         name = brand = symbol = category = lv2category = ''
@@ -128,37 +247,27 @@ def build(msg):
     else:
         name = msg.get('name', None)
         if not name:
-            emit('buildlog', 'Name is empty, cannot continue')
-            emit('status', 'error')
-            return
+            return None, 'Name is empty, cannot continue'
 
         name = sanitize(name)
         if not name:
-            emit('buildlog', 'Invalid name, cannot continue')
-            emit('status', 'error')
-            return
+            return None, 'Invalid name, cannot continue'
 
         brand = msg.get('brand', None)
         if brand is None:
-            emit('buildlog', 'Brand is null, cannot continue')
-            emit('status', 'error')
-            return
+            return None, 'Brand is null, cannot continue'
 
         brand = sanitize(brand)
 
         symbol = msg.get('symbol', None)
         if not symbol:
-            emit('buildlog', 'Symbol is empty, cannot continue')
-            emit('status', 'error')
-            return
+            return None, 'Symbol is empty, cannot continue'
 
         symbol = symbolify(symbol)
 
         category = msg.get('category', None)
         if category is None or category not in categories:
-            emit('buildlog', 'Invalid category, cannot continue')
-            emit('status', 'error')
-            return
+            return None, 'Invalid category, cannot continue'
 
         if category == '(none)':
             lv2category = 'lv2:Plugin'
@@ -166,45 +275,42 @@ def build(msg):
             lv2category = f"lv2:{category}Plugin"
 
     files = msg.get('files', None)
-    if not files:
-        emit('buildlog', 'No files provided, cannot continue')
-        emit('status', 'error')
-        return
+    if not files or not isinstance(files, dict):
+        return None, 'No files provided, cannot continue'
+
+    # files are written to disk by name, both here for validation and on the builders
+    for filename, content in files.items():
+        if not filename or filename != os.path.basename(filename) or filename in ('.', '..') or '\\' in filename:
+            return None, f'Invalid filename "{filename}", cannot continue'
+        if not isinstance(content, str):
+            return None, f'Invalid contents for "{filename}", cannot continue'
+
+    main = None
 
     if buildtype == 'buildroot':
         if len(files.keys()) != 1:
-            emit('buildlog', 'More than 1 file uploaded, this is not allowed, please upload a single file')
-            emit('status', 'error')
-            return
+            return None, 'More than 1 file uploaded, this is not allowed, please upload a single file'
 
         filename = tuple(files.keys())[0]
 
         if not filename.endswith('.mk'):
-            emit('buildlog', 'Wrong file extension, please upload a buildroot makefile with .mk extension')
-            emit('status', 'error')
-            return
+            return None, 'Wrong file extension, please upload a buildroot makefile with .mk extension'
 
         bundle = filename[:-3]
 
         if not bundle or bundle[0].isdigit():
-            emit('buildlog', 'Wrong or incorrect file, stop')
-            emit('status', 'error')
-            return
+            return None, 'Wrong or incorrect file, stop'
 
         for c in bundle:
             if (c >= 'a' and c <= 'z') or (c >= '0' and c <= '9') or c == '-':
                 continue
-            emit('buildlog', 'Filename contains invalid character(s)')
-            emit('status', 'error')
-            return
+            return None, 'Filename contains invalid character(s)'
 
         package = files[filename]
 
     elif buildtype == 'faust':
         if len(files.keys()) != 1:
-            emit('buildlog', 'More than 1 file uploaded, this is not allowed, please upload a single file')
-            emit('status', 'error')
-            return
+            return None, 'More than 1 file uploaded, this is not allowed, please upload a single file'
 
         if not brand:
             brand = 'FAUST'
@@ -244,14 +350,10 @@ $(eval $(generic-package))
 
     elif buildtype == 'maxgen':
         if 'gen_exported.cpp' not in files:
-            emit('buildlog', 'The file gen_exported.cpp is missing, cannot continue')
-            emit('status', 'error')
-            return
+            return None, 'The file gen_exported.cpp is missing, cannot continue'
 
         if 'gen_exported.h' not in files:
-            emit('buildlog', 'The file gen_exported.h is missing, cannot continue')
-            emit('status', 'error')
-            return
+            return None, 'The file gen_exported.h is missing, cannot continue'
 
         if not brand:
             brand = 'MAX gen~'
@@ -292,16 +394,12 @@ $(eval $(generic-package))
 
     elif buildtype == 'hvcc':
         if "main" not in files:
-            emit('buildlog', 'No main file selected')
-            emit('status', 'error')
-            return
+            return None, 'No main file selected'
 
         main = files.pop("main")
 
         if main not in files:
-            emit('buildlog', 'The main file was not found')
-            emit('status', 'error')
-            return
+            return None, 'The main file was not found'
 
         if not brand:
             brand = 'Pure Data'
@@ -320,8 +418,8 @@ PURE_DATA_SKELETON_BUNDLES = {bundle}.lv2
 PURE_DATA_SKELETON_TARGET_MAKE = $(TARGET_MAKE_ENV) $(TARGET_CONFIGURE_OPTS) $(MAKE) PREFIX=/usr NOOPT=true -C $(@D)
 
 define PURE_DATA_SKELETON_CONFIGURE_CMDS
-	# install hvcc
-	pip3 install -e $(@D) --break-system-packages
+	# install hvcc, unless builder already provides it
+	command -v hvcc > /dev/null || pip3 install -e $(@D) --break-system-packages
 	# place symlink to dpf (known working version)
 	ln -s /root/dpf $(@D)/dpf
 	# place symlink to heavylib
@@ -359,120 +457,825 @@ $(eval $(generic-package))
 """
 
     else:
-        emit('buildlog', 'Requested build target is not yet implemented, cannot continue')
-        emit('status', 'error')
-        return
-
-    reqheaders = {
-      'Content-Type': 'application/json; charset=UTF-8',
+        return None, 'Requested build target is not yet implemented, cannot continue'
+
+    plugin = {
+        'type': buildtype,
+        'name': name,
+        'brand': brand,
+        'symbol': symbol,
+        'category': category,
+        'bundle': bundle,
+        'files': files,
+        'main': main,
+        'package': package,
     }
+    return plugin, None
+
+# quick source checks, so broken submissions fail before reaching a builder
+def validate_faust(filename, content):
+    faust = which('faust')
+
+    # the local faust can be older than the one used by the builders, and so miss newer library functions,
+    # only syntax errors are reported from it
+    if faust is not None:
+        with TemporaryDirectory() as tmpdir:
+            with open(os.path.join(tmpdir, filename), 'w') as fh:
+                fh.write(content)
+
+            try:
+                proc = run([faust, '-o', os.devnull, filename], cwd=tmpdir, stdout=PIPE, stderr=STDOUT, timeout=10)
+            except TimeoutExpired:
+                # slow to compile does not mean broken, leave it to the builder
+                return None
+
+        output = proc.stdout.decode('utf-8', 'replace').strip()
+        if proc.returncode != 0 and re_search(r'syntax error|lexical error', output, IGNORECASE):
+            return output
+
+    if not re_search(r'(^|[;{])\s*process\s*(\(|=)', content, MULTILINE):
+        return f'{filename}: no "process" definition found'
+
+    return None
+
+def validate_pd(filename, content):
+    if not content.startswith('#N canvas'):
+        return f'{filename}: not a Pure Data patch'
+
+    # object count per open canvas, for validating connections
+    canvases = []
+    line = 1
+    pos = 0
+
+    for record in re_finditer(r'(?:[^;\\]|\\.)*;', content):
+        start = record.start() + len(record.group(0)) - len(record.group(0).lstrip())
+        line += content.count('\n', pos, start)
+        atoms = record.group(0)[:-1].split()
+        pos = start
+
+        if len(atoms) < 2:
+            continue
+
+        if atoms[:2] == ['#N', 'canvas']:
+            canvases.append(0)
+
+        elif atoms[:2] == ['#X', 'restore']:
+            if len(canvases) < 2:
+                return f'{filename}:{line}: unbalanced subpatch'
+            canvases.pop()
+            canvases[-1] += 1
+
+        elif atoms[0] == '#X' and atoms[1] in ('obj', 'msg', 'floatatom', 'symbolatom', 'listbox', 'text', 'scalar'):
+            canvases[-1] += 1
+
+        elif atoms[:2] == ['#X', 'connect']:
+            if len(atoms) != 6 or not all(atom.isdigit() for atom in atoms[2:]):
+                return f'{filename}:{line}: malformed connection'
+            if int(atoms[2]) >= canvases[-1] or int(atoms[4]) >= canvases[-1]:
+                return f'{filename}:{line}: connection to a non-existent object'
+
+    if content[content.rfind(';')+1:].strip():
+        return f'{filename}: unterminated record at end of file'
+
+    if len(canvases) != 1:
+        return f'{filename}: unbalanced subpatch'
+
+    return None
+
+def validate_hvcc(files, main):
+    for filename, content in files.items():
+        if filename.endswith('.pd'):
+            error = validate_pd(filename, content)
+            if error is not None:
+                return error
+
+    if pd2hv is None:
+        return None
 
-    if persistent:
-        devices = list(targets.keys())
-        devices.remove(device)
-        outdir = mkdtemp(prefix='', dir=BUILDER_STORAGE)
+    # parse the full graph through hvcc, without generating any code
+    with TemporaryDirectory() as tmpdir:
+        for filename, content in files.items():
+            with open(os.path.join(tmpdir, os.path.basename(filename)), 'w') as fh:
+                fh.write(content)
 
-    @copy_current_request_context
-    def create_build_req(targethost):
-        reqdata = json.dumps({
-            'name': name,
-            'files': files,
-            'package': package,
-        }).encode('utf-8')
+        search_paths = [HEAVYLIB_DIR] if os.path.exists(HEAVYLIB_DIR) else []
+        results = pd2hv.compile(os.path.join(tmpdir, main), os.path.join(tmpdir, 'hv'), search_paths=search_paths)
 
-        req = urlopen(Request(f'http://{targethost}/', data=reqdata, headers=reqheaders, method='POST'))
-        resp = json.loads(req.read().decode('utf-8'))
+    # older hvcc versions return plain dicts, newer ones objects
+    notifs = results['notifs'] if isinstance(results, dict) else results.notifs
+    if isinstance(notifs, dict):
+        errors = [error['message'] for error in notifs['errors']] if notifs['has_error'] else []
+    else:
+        errors = [error.message for error in notifs.errors] if notifs.has_error else []
 
-        if not resp['ok']:
-            emit('buildlog', resp['error'])
-            emit('status', 'error')
-            return None, None
+    if errors:
+        return '\n'.join(errors).replace(tmpdir + os.sep, '')
 
-        ws = create_connection(f'ws://{targethost}/build')
-        ws.send(resp['id'])
+    return None
 
-        if not ws.connected:
-            emit('buildlog', 'failed to start server-side build job')
-            emit('status', 'error')
-            ws.close()
-            return None, None
+def validate_buildroot(filename, content):
+    # only reject what make or the builder cannot handle, any other makefile construct is left to buildroot
+    defines = []
+    variables = {}
+    continued = False
 
-        return ws, resp['id']
+    for lineno, line in enumerate(content.split('\n'), 1):
+        if continued:
+            continued = line.endswith('\\')
+            continue
 
-    @copy_current_request_context
-    def buildlog(ws, reqid, device):
-        if not ws.connected:
-            emit('buildlog', 'server-side build job closed unexpectedly')
-            emit('status', 'error')
-            ws.close()
-            return
+        continued = line.endswith('\\')
+        line = line.split('#',1)[0].rstrip()
 
-        recv = ws.recv()
-        if not recv or not ws.connected:
-            emit('buildlog', 'server-side build job closed unexpectedly')
-            emit('status', 'error')
-            ws.close()
+        if line.lstrip(' ').startswith('define '):
+            defines.append(lineno)
+            continue
+
+        if line.strip() == 'endef':
+            if not defines:
+                return f'{filename}:{lineno}: endef without define'
+            defines.pop()
+            continue
+
+        if defines or not line or line[0] == '\t':
+            continue
+
+        # assignments inside conditionals are usually indented with spaces
+        line = line.lstrip(' ')
+        assignment = re_match(r'^([A-Za-z0-9_]+)\s*(\+=|:=|\?=|=)', line)
+        if assignment is not None:
+            variables[assignment.group(1)] = line[assignment.end():].strip()
+
+    if defines:
+        return f'{filename}:{defines[-1]}: define without endef'
+
+    # the builder looks for these exact assignments, taking the package name from the first version
+    version = re_search(r'^([A-Za-z0-9_]+)_VERSION = ', content, MULTILINE)
+    if version is None:
+        return f'{filename}: missing <PACKAGE>_VERSION variable, must be assigned as "<PACKAGE>_VERSION = value"'
+
+    pkgname = version.group(1)
+    if f'\n{pkgname}_BUNDLES = ' not in '\n' + content:
+        return f'{filename}: {pkgname}_BUNDLES must be assigned as "{pkgname}_BUNDLES = value"'
+
+    for suffix in ('_SITE', '_BUNDLES'):
+        if not variables.get(pkgname + suffix, None):
+            return f'{filename}: missing {pkgname}{suffix} variable'
+
+    if ' ' in variables[pkgname + '_BUNDLES']:
+        return f'{filename}: multiple bundles per package is not supported'
+
+    if not re_search(r'^\$\(eval \$\([a-z-]*package\)\)', content, MULTILINE):
+        return f'{filename}: missing $(eval $(generic-package)) or similar'
+
+    return None
+
+def validate_maxgen(files):
+    header = files['gen_exported.h']
+    source = files['gen_exported.cpp']
+
+    if 'namespace gen_exported' not in header:
+        return 'gen_exported.h: missing gen_exported namespace, is this a gen~ export?'
+
+    if 'namespace gen_exported' not in source:
+        return 'gen_exported.cpp: missing gen_exported namespace, is this a gen~ export?'
+
+    if not re_search(r'#include\s+"gen_exported\.h"', source):
+        return 'gen_exported.cpp: does not include gen_exported.h'
+
+    for function in ('num_inputs', 'num_outputs', 'num_params', 'perform', 'reset',
+                     'setparameter', 'getparameter', 'create', 'destroy'):
+        if not re_search(rf'\b{function}\s*\([^;]*\)\s*\{{', source):
+            return f'gen_exported.cpp: missing definition for {function}()'
+
+    return None
+
+def validate_plugin(plugin):
+    files = plugin['files']
+
+    if plugin['type'] == 'buildroot':
+        filename = tuple(files.keys())[0]
+        return validate_buildroot(filename, files[filename])
+
+    if plugin['type'] == 'faust':
+        filename = tuple(files.keys())[0]
+        return validate_faust(os.path.basename(filename), files[filename])
+
+    if plugin['type'] == 'hvcc':
+        return validate_hvcc(files, plugin['main'])
+
+    if plugin['type'] == 'maxgen':
+        return validate_maxgen(files)
+
+    return None
+
+def builder_start(targethost, plugin):
+    reqdata = json.dumps({
+        'name': plugin['name'],
+        'files': plugin['files'],
+        'package': plugin['package'],
+    }).encode('utf-8')
+
+    req = urlopen(Request(f'http://{targethost}/', data=reqdata, headers=reqheaders, method='POST'))
+    resp = json.loads(req.read().decode('utf-8'))
+
+    if not resp['ok']:
+        return None, None, resp['error']
+
+    ws = create_connection(f'ws://{targethost}/build')
+    ws.send(resp['id'])
+
+    if not ws.connected:
+        ws.close()
+        return None, None, 'failed to start server-side build job'
+
+    return ws, resp['id'], None
+
+def builder_fetch(targethost, reqid):
+    reqdata = json.dumps({
+        'id': reqid
+    }).encode('utf-8')
+    req = urlopen(Request(f'http://{targethost}/', data=reqdata, headers=reqheaders, method='GET'))
+    data = req.read()
+
+    digest = req.headers.get('X-MCB-SHA256', None)
+    if digest is not None and sha256(data).hexdigest() != digest:
+        return None, 'build file checksum mismatch, cannot continue'
+
+    artifact = {
+        'data': data,
+        'compression': req.headers.get('X-MCB-Compression', 'gzip'),
+        'size': len(data),
+        'sha256': digest or sha256(data).hexdigest(),
+    }
+    return artifact, None
+
+# compressed build logs, stored as independent gzip chunks plus a line index
+# so that any range of lines can be read back by decompressing only the chunks it spans
+class BuildLog(object):
+    def __init__(self, path):
+        self.path = path
+        self.pending = []
+        self.size = 0
+        self.index = {
+            'lines': 0,
+            'chunks': [],
+            'errors': [],
+        }
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path + '.log.gz', 'wb').close()
+        self.write_index()
+
+    def append(self, text):
+        if isinstance(text, bytes):
+            text = text.decode('utf-8', 'replace')
+
+        for line in text.rstrip('\n').split('\n'):
+            if LOG_ERROR_PATTERN.search(line):
+                self.index['errors'].append(self.index['lines'] + len(self.pending))
+            self.pending.append(line)
+
+        if len(self.pending) >= LOG_CHUNK_LINES:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
             return
 
-        elif recv == '--- END ---':
-            reqdata = json.dumps({
-                'id': reqid
-            }).encode('utf-8')
-            req = urlopen(Request(f'http://{targets[device]}/', data=reqdata, headers=reqheaders, method='GET'))
-            resp = req.read()
-            ws.close()
+        data = gzip_compress(('\n'.join(self.pending) + '\n').encode('utf-8'))
 
-            # store build file on client side for the first build
-            if not persistent or len(devices) == len(targets.keys()) - 1:
-                emit('buildfile', encodebytes(resp).decode('utf-8'))
+        with open(self.path + '.log.gz', 'ab') as fh:
+            fh.write(data)
 
-            # regular single build
-            if not persistent:
-                emit('status', 'finished')
-                return
+        self.index['chunks'].append([self.size, self.index['lines']])
+        self.index['lines'] += len(self.pending)
+        self.size += len(data)
+        self.pending = []
+        self.write_index()
 
-            # multi-target build
-            with open(os.path.join(outdir, device + '.tar.gz'), 'wb') as fh:
-                fh.write(resp)
-
-            if not devices:
-                with open(os.path.join(BUILDER_STORAGE, outdir, 'config.json'), 'w') as fh:
-                    config = {
-                        'name': name,
-                        'brand': brand,
-                        'category': category,
-                    }
-                    fh.write(json.dumps(config))
-
-                emit('buildlog', '----------------------------------------')
-                emit('buildlog', 'All builds completed.')
-                emit('buildurl', os.path.basename(outdir))
-                emit('status', 'finished')
-                return
+    def close(self):
+        self.flush()
+
+    def write_index(self):
+        with open(self.path + '.log.json', 'w') as fh:
+            fh.write(json.dumps(self.index))
+
+def read_log_chunks(path, first=0, last=None, lines=None):
+    # yields (first line number, lines) for each chunk within [first, last) or containing any of lines
+    with open(path + '.log.json', 'r') as fh:
+        index = json.load(fh)
+
+    if last is None:
+        last = index['lines']
+
+    chunks = index['chunks'] + [[os.path.getsize(path + '.log.gz'), index['lines']]]
+
+    with open(path + '.log.gz', 'rb') as fh:
+        for (offset, start), (nextoffset, end) in zip(chunks, chunks[1:]):
+            if end <= first or start >= last:
+                continue
+            if lines is not None and not any(start <= line < end for line in lines):
+                continue
+            fh.seek(offset)
+            yield start, gzip_decompress(fh.read(nextoffset - offset)).decode('utf-8').split('\n')[:-1]
+
+def read_log(path):
+    with open(path + '.log.json', 'r') as fh:
+        index = json.load(fh)
+
+    total = index['lines']
+    args = request.args
+
+    if 'grep' in args or 'errors' in args:
+        if 'grep' in args:
+            # literal match only, client regexes could stall the whole worker
+            if len(args['grep']) > 256:
+                return { 'ok': False, 'error': 'Search string is too long' }, 400
+            pattern = re_compile(re_escape(args['grep']))
+            lines = None
+        else:
+            pattern = LOG_ERROR_PATTERN
+            lines = index['errors']
+
+        limit = min(args.get('limit', 1000, type=int), 1000)
+        matches = []
+        for start, chunk in read_log_chunks(path, lines=lines):
+            for lineno, line in enumerate(chunk, start):
+                if pattern.search(line):
+                    matches.append([lineno, line])
+            if len(matches) >= limit:
+                break
+
+        return { 'ok': True, 'lines': total, 'matches': matches[:limit] }
+
+    if 'tail' in args:
+        first = max(total - min(args.get('tail', 0, type=int), 1000), 0)
+        last = total
+    else:
+        first = max(args.get('start', 0, type=int), 0)
+        last = min(args.get('end', first + 1000, type=int), first + 1000)
+
+    log = []
+    for start, chunk in read_log_chunks(path, first, last):
+        log.extend(chunk[max(first - start, 0):last - start])
+
+    return { 'ok': True, 'lines': total, 'start': first, 'log': log }
+
+# content-addressed storage for persistent builds
+# each stored build keeps a manifest per target, listing the blobs of its bundle files
+def blob_path(digest):
+    return os.path.join(BLOB_STORAGE, digest[:2], digest[2:])
+
+@contextmanager
+def blob_lock():
+    os.makedirs(BLOB_STORAGE, exist_ok=True)
+    with open(os.path.join(BLOB_STORAGE, '.lock'), 'w') as fh:
+        flock(fh, LOCK_EX)
+        try:
+            yield
+        finally:
+            flock(fh, LOCK_UN)
+
+def blob_ref(digest, delta):
+    # must be called with blob_lock held
+    path = blob_path(digest)
+
+    try:
+        with open(path + '.refs', 'r') as fh:
+            refs = int(fh.read())
+    except FileNotFoundError:
+        refs = 0
+
+    refs += delta
+
+    if refs > 0:
+        with open(path + '.refs', 'w') as fh:
+            fh.write(str(refs))
+        return
+
+    for filename in (path, path + '.refs'):
+        if os.path.exists(filename):
+            os.remove(filename)
+
+def blob_store(data):
+    # must be called with blob_lock held
+    digest = sha256(data).hexdigest()
+    path = blob_path(digest)
+
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as fh:
+            fh.write(data)
+        os.rename(path + '.tmp', path)
+
+    blob_ref(digest, 1)
+    return digest
+
+def blob_release(path):
+    # must be called with blob_lock held, removes a manifest and drops its blob references
+    with open(path, 'r') as fh:
+        manifest = json.load(fh)
+
+    for entry in manifest['entries']:
+        if entry['type'] == 'file':
+            blob_ref(entry['blob'], -1)
+
+    # do not release blobs twice if removal fails later on
+    os.remove(path)
+
+def store_artifact(outdir, device, artifact):
+    data = artifact.pop('data')
+
+    # python tarfile does not handle zstd
+    if artifact['compression'] == 'zstd':
+        data = run(['zstd', '-dcq'], input=data, stdout=PIPE, check=True).stdout
+
+    # read the whole archive first, so a broken one does not leave references to blobs behind
+    entries = []
+    contents = []
+    with tarfile.open(fileobj=BytesIO(data), mode='r:*') as tar:
+        for member in tar:
+            entry = {
+                'path': member.name,
+                'mode': member.mode,
+                'mtime': member.mtime,
+            }
+
+            if member.isdir():
+                entry['type'] = 'dir'
+            elif member.issym():
+                entry['type'] = 'symlink'
+                entry['target'] = member.linkname
+            elif member.isfile() or member.islnk():
+                content = tar.extractfile(member).read()
+                entry['type'] = 'file'
+                entry['size'] = len(content)
+                contents.append((entry, content))
+            else:
+                continue
+
+            entries.append(entry)
+
+    with blob_lock():
+        # a resumed build replaces what the interrupted run stored for this target
+        if os.path.exists(os.path.join(outdir, device + '.json')):
+            blob_release(os.path.join(outdir, device + '.json'))
+
+        for entry, content in contents:
+            entry['blob'] = blob_store(content)
+
+    # MOD units always receive a gzip tarball, record the digest of what is actually delivered
+    data = pack_entries(entries)
+    artifact['source'] = dict((key, artifact.pop(key)) for key in ('compression', 'size', 'sha256'))
+    artifact['compression'] = 'gzip'
+    artifact['size'] = len(data)
+    artifact['sha256'] = sha256(data).hexdigest()
+    artifact['manifest'] = device + '.json'
+
+    with open(os.path.join(outdir, artifact['manifest']), 'w') as fh:
+        fh.write(json.dumps(dict(artifact, entries=entries)))
+
+    return artifact
+
+def pack_entries(entries):
+    # fixed gzip header mtime, so the same entries always give the same tarball
+    data = BytesIO()
+    with GzipFile(fileobj=data, mode='wb', compresslevel=6, mtime=0) as gz, tarfile.open(fileobj=gz, mode='w') as tar:
+        for entry in entries:
+            info = tarfile.TarInfo(entry['path'])
+            info.mode = entry['mode']
+            info.mtime = entry['mtime']
+
+            if entry['type'] == 'dir':
+                info.type = tarfile.DIRTYPE
+                tar.addfile(info)
+            elif entry['type'] == 'symlink':
+                info.type = tarfile.SYMTYPE
+                info.linkname = entry['target']
+                tar.addfile(info)
+            else:
+                with open(blob_path(entry['blob']), 'rb') as fh:
+                    content = fh.read()
+                if sha256(content).hexdigest() != entry['blob']:
+                    raise ValueError(f'blob {entry["blob"]} is corrupt')
+                info.size = len(content)
+                tar.addfile(info, BytesIO(content))
+
+    return data.getvalue()
+
+# assembled tarballs are kept around, so repeated fetches do not compress the bundle again
+@lru_cache(maxsize=16)
+def assemble_artifact(outdir, device):
+    with open(os.path.join(outdir, device + '.json'), 'r') as fh:
+        manifest = json.load(fh)
+
+    data = pack_entries(manifest['entries'])
+
+    if sha256(data).hexdigest() != manifest['sha256']:
+        raise ValueError(f'assembled {device} tarball does not match its manifest')
+
+    return data
+
+def remove_stored_build(outdir):
+    with blob_lock():
+        for filename in os.listdir(outdir):
+            if not filename.endswith('.json') or filename == 'config.json':
+                continue
+
+            blob_release(os.path.join(outdir, filename))
 
-            # trigger next build
-            device = devices.pop(0)
+    rmtree(outdir)
+    assemble_artifact.cache_clear()
 
-            emit('buildlog', '----------------------------------------')
-            emit('buildlog', f'Starting build for {device}...')
+def storage_cleanup():
+    while True:
+        expiry = time() - BUILDER_STORAGE_RETENTION * 86400
+
+        for basename in os.listdir(BUILDER_STORAGE):
+            outdir = os.path.join(BUILDER_STORAGE, basename)
+            if outdir in (API_STORAGE, BLOB_STORAGE, LOG_STORAGE) or not os.path.isdir(outdir):
+                continue
+            try:
+                # only touch directories that look like stored builds
+                if not any(filename.endswith('.json') for filename in os.listdir(outdir)):
+                    continue
+                if os.path.getmtime(outdir) < expiry:
+                    print('removing expired build', basename)
+                    remove_stored_build(outdir)
+            except Exception as e:
+                print('failed to remove expired build', basename, e)
+
+        if os.path.exists(LOG_STORAGE):
+            for logid in os.listdir(LOG_STORAGE):
+                try:
+                    if os.path.getmtime(os.path.join(LOG_STORAGE, logid)) < expiry:
+                        rmtree(os.path.join(LOG_STORAGE, logid))
+                except Exception as e:
+                    print('failed to remove expired log', logid, e)
+
+        if os.path.exists(API_STORAGE):
+            for batch in os.listdir(API_STORAGE):
+                try:
+                    if os.path.getmtime(os.path.join(API_STORAGE, batch)) < expiry:
+                        print('removing expired batch', batch)
+                        with state_db() as db:
+                            db.execute('DELETE FROM job_logs WHERE job IN (SELECT id FROM jobs WHERE batch = ?)', (batch,))
+                            db.execute('DELETE FROM jobs WHERE batch = ?', (batch,))
+                        rmtree(os.path.join(API_STORAGE, batch))
+                except Exception as e:
+                    print('failed to remove expired batch', batch, e)
+
+        sleep(3600)
+
+def gzip_artifact(data, compression):
+    # MOD units only understand gzip, convert anything else
+    if compression == 'gzip' or not data:
+        return data
+
+    proc = run(['zstd', '-dcq'], input=data, stdout=PIPE)
+    if proc.returncode != 0:
+        return None
 
-            ws, reqid = create_build_req(targets[device])
-            if ws is None:
+    return gzip_compress(proc.stdout, compresslevel=6)
+
+# web UI builds keep their progress in the shared state database, so any worker can resume them
+# and a browser that reconnects to another worker can attach to them again
+def web_build_emit(state, event, data):
+    socketio.emit(event, data, to=state['sid'])
+
+def web_build_update(db, state, sql, params=()):
+    # same ownership rules as batch jobs, returns whether this run still owns the build
+    cursor = db.execute(sql + ' WHERE id = ? AND owner = ? AND attempt = ?',
+                        tuple(params) + (state['id'], os.getpid(), state['attempt']))
+    return cursor.rowcount == 1
+
+def web_build_json(state):
+    # connection and attempt have their own columns
+    return json.dumps(dict((key, value) for key, value in state.items() if key not in ('sid', 'attempt')))
+
+def web_build_save(state):
+    with state_db() as db:
+        return web_build_update(db, state, 'UPDATE web_builds SET state = ?, heartbeat = ?', (web_build_json(state), time()))
+
+def web_build_heartbeat(state):
+    # also picks up the connection of a browser that attached to the build again
+    while True:
+        sleep(JOB_HEARTBEAT_INTERVAL)
+        with state_db() as db:
+            if not web_build_update(db, state, 'UPDATE web_builds SET heartbeat = ?', (time(),)):
                 return
+            state['sid'] = db.execute('SELECT sid FROM web_builds WHERE id = ?', (state['id'],)).fetchone()['sid']
 
-            spawn(buildlog, ws, reqid, device)
-            return
+def web_build_target(state, device):
+    log = BuildLog(os.path.join(LOG_STORAGE, state['id'], device))
+    artifact, error, ws = None, None, None
+
+    # the log is always written out, failures that end the relay are its last line
+    try:
+        ws, reqid, error = builder_start(targets[device], state['plugin'])
+
+        while error is None:
+            recv = ws.recv() if ws.connected else None
+            if not recv or not ws.connected:
+                error = 'server-side build job closed unexpectedly'
+                break
+
+            if recv == '--- END ---':
+                ws.close()
+                artifact, error = builder_fetch(targets[device], reqid)
+                break
+
+            if isinstance(recv, bytes):
+                recv = recv.decode('utf-8', 'replace')
+
+            print(recv, end='')
+            log.append(recv)
+            web_build_emit(state, 'buildlog', recv)
 
-        print(recv, end='')
-        emit('buildlog', recv)
-        spawn(buildlog, ws, reqid, device)
+    except Exception as e:
+        artifact, error = None, f'build failed: {e}'
 
-    ws, reqid = create_build_req(targets[device])
-    if ws is None:
+    finally:
+        if ws is not None:
+            ws.close()
+
+    if error is None and not artifact['size']:
+        log.append('build did not produce a bundle')
+    if error is not None:
+        log.append(error)
+    log.close()
+
+    return artifact, error
+
+def web_build_steps(state):
+    # returns the final status, or None if another worker took over the build
+    while True:
+        device = state['device']
+        artifact, error = web_build_target(state, device)
+
+        if error is not None:
+            web_build_emit(state, 'buildlog', error)
+            return 'error'
+
+        # failed builds of a multi-target build are skipped, the other targets can still succeed
+        if not artifact['size']:
+            web_build_emit(state, 'buildlog', 'build did not produce a bundle')
+            if not state['persistent']:
+                return 'error'
+
+        # store build file on client side for the first build
+        elif device == state['first']:
+            data = gzip_artifact(artifact['data'], artifact['compression'])
+            if data is None:
+                web_build_emit(state, 'buildlog', 'failed to convert build file for the MOD unit')
+                return 'error'
+            web_build_emit(state, 'buildfile', encodebytes(data).decode('utf-8'))
+
+        # regular single build
+        if not state['persistent']:
+            return 'finished'
+
+        # multi-target build
+        outdir = os.path.join(BUILDER_STORAGE, state['outdir'])
+
+        if artifact['size']:
+            try:
+                state['artifacts'][device] = store_artifact(outdir, device, artifact)
+            except (CalledProcessError, EOFError, OSError, tarfile.TarError, zlib_error) as e:
+                web_build_emit(state, 'buildlog', f'failed to store build file: {e}')
+                return 'error'
+
+        if not state['devices']:
+            break
+
+        # trigger next build, from here on any worker can resume it
+        state['device'] = state['devices'].pop(0)
+        if not web_build_save(state):
+            return None
+
+        web_build_emit(state, 'buildlog', '----------------------------------------')
+        web_build_emit(state, 'buildlog', f'Starting build for {state["device"]}...')
+
+    if not state['artifacts']:
+        rmtree(outdir)
+        web_build_emit(state, 'buildlog', '----------------------------------------')
+        web_build_emit(state, 'buildlog', 'No builds completed.')
+        return 'error'
+
+    with open(os.path.join(outdir, 'config.json'), 'w') as fh:
+        config = {
+            'name': state['plugin']['name'],
+            'brand': state['plugin']['brand'],
+            'category': state['plugin']['category'],
+            'artifacts': state['artifacts'],
+            'log': state['id'],
+        }
+        fh.write(json.dumps(config))
+
+    web_build_emit(state, 'buildlog', '----------------------------------------')
+    web_build_emit(state, 'buildlog', 'All builds completed.')
+    web_build_emit(state, 'buildurl', state['outdir'])
+    return 'finished'
+
+def run_web_build(state):
+    if state['attempt'] > 1:
+        print('resuming build', state['id'])
+        web_build_emit(state, 'buildlog', '----------------------------------------')
+        web_build_emit(state, 'buildlog', f'Build was interrupted, restarting build for {state["device"]}...')
+
+    heartbeat = spawn(web_build_heartbeat, state)
+
+    try:
+        status = web_build_steps(state)
+    except Exception as e:
+        web_build_emit(state, 'buildlog', f'build failed: {e}')
+        status = 'error'
+
+    heartbeat.kill()
+
+    if status is None:
+        print('build was taken over by another worker', state['id'])
         return
 
+    with state_db() as db:
+        if web_build_update(db, state, 'DELETE FROM web_builds'):
+            web_build_emit(state, 'status', status)
+
+def claim_web_builds():
+    # resume web UI builds of workers that died while building
+    with state_db() as db:
+        db.execute('BEGIN IMMEDIATE')
+
+        rows = db.execute('SELECT * FROM web_builds WHERE heartbeat < ?', (time() - JOB_HEARTBEAT_TIMEOUT,)).fetchall()
+
+        claimed = []
+        for row in rows:
+            state = dict(json.loads(row['state']), id=row['id'], sid=row['sid'], attempt=row['attempt'] + 1)
+            db.execute('UPDATE web_builds SET owner = ?, attempt = ?, heartbeat = ? WHERE id = ?',
+                       (os.getpid(), state['attempt'], time(), state['id']))
+            claimed.append(state)
+
+    return claimed
+
+@socketio.on('build')
+def build(msg):
+    print('build started')
+
+    device = msg.get('device', None)
+    if device is None or device not in targets:
+        emit('buildlog', 'Invalid device target, cannot continue')
+        emit('status', 'error')
+        return
+
+    persistent = bool(msg.get('persistent', False))
+
+    plugin, error = create_package(msg)
+    if error is None:
+        error = validate_plugin(plugin)
+    if error is not None:
+        emit('buildlog', error)
+        emit('status', 'error')
+        return
+
+    # keep build logs around, for looking at them after the fact
+    os.makedirs(LOG_STORAGE, exist_ok=True)
+    logid = os.path.basename(mkdtemp(prefix='', dir=LOG_STORAGE))
+
+    state = {
+        'id': logid,
+        'sid': request.sid,
+        'attempt': 1,
+        'plugin': plugin,
+        'persistent': persistent,
+        'device': device,
+        'first': device,
+        'devices': [target for target in targets.keys() if target != device] if persistent else [],
+        'outdir': os.path.basename(mkdtemp(prefix='', dir=BUILDER_STORAGE)) if persistent else None,
+        'artifacts': {},
+    }
+
+    with state_db() as db:
+        db.execute('INSERT INTO web_builds (id, sid, state, owner, attempt, heartbeat) VALUES (?, ?, ?, ?, ?, ?)',
+                   (logid, request.sid, web_build_json(state), os.getpid(), 1, time()))
+
+    emit('buildid', logid)
+    emit('buildlog', f'Build log id: {logid}')
     emit('status', 'building')
-    spawn(buildlog, ws, reqid, device)
+    spawn(run_web_build, state)
+
+@socketio.on('attach')
+def attach(buildid):
+    # browser reconnected while its build was running, possibly to another worker
+    with state_db() as db:
+        attached = db.execute('UPDATE web_builds SET sid = ? WHERE id = ?', (request.sid, str(buildid))).rowcount == 1
+
+    if not attached:
+        emit('buildlog', 'Build is no longer running, check its log for the result')
+        emit('status', 'error')
+        return
+
+    emit('buildlog', 'Reconnected, waiting for build output...')
 
 @socketio.on('fetch')
 def fetch(msg):
@@ -496,17 +1299,403 @@ def fetch(msg):
         emit('status', 'error')
         return
 
-    filename = os.path.join(BUILDER_STORAGE, basename, device + '.tar.gz')
-    if not os.path.exists(filename):
+    outdir = os.path.join(BUILDER_STORAGE, basename)
+
+    # builds stored before the blob storage keep their full tarballs
+    if os.path.exists(os.path.join(outdir, device + '.json')):
+        try:
+            data = assemble_artifact(outdir, device)
+        except (OSError, ValueError) as e:
+            print('fetch failed:', e)
+            emit('fetchlog', 'Stored build file is damaged, cannot continue')
+            emit('status', 'error')
+            return
+
+    elif os.path.exists(os.path.join(outdir, device + '.tar.gz')):
+        with open(os.path.join(outdir, device + '.tar.gz'), 'rb') as fh:
+            data = fh.read()
+
+    elif os.path.exists(os.path.join(outdir, device + '.tar.zst')):
+        with open(os.path.join(outdir, device + '.tar.zst'), 'rb') as fh:
+            data = gzip_artifact(fh.read(), 'zstd')
+
+    else:
         emit('fetchlog', 'Non-existent filename, cannot continue')
         emit('status', 'error')
         return
 
-    with open(filename, 'rb') as fh:
-        emit('fetchfile', encodebytes(fh.read()).decode('utf-8'))
+    if data is None:
+        emit('fetchlog', 'Failed to convert build file, cannot continue')
+        emit('status', 'error')
+        return
+
+    emit('fetchfile', encodebytes(data).decode('utf-8'))
 
     emit('status', 'finished')
 
+# batch build API, jobs are kept in a sqlite database shared by all webserver workers
+# and are processed one at a time per target
+@contextmanager
+def state_db():
+    db = sqlite3.connect(STATE_DB, timeout=30)
+    db.row_factory = sqlite3.Row
+    try:
+        with db:
+            yield db
+    finally:
+        db.close()
+
+def state_init():
+    with state_db() as db:
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, batch TEXT, seq INTEGER, bundle TEXT, device TEXT, '
+                   'status TEXT, error TEXT, artifact TEXT, plugin TEXT, created REAL)')
+        db.execute('CREATE INDEX IF NOT EXISTS jobs_batch ON jobs (batch, seq)')
+        db.execute('CREATE TABLE IF NOT EXISTS job_logs (job TEXT, lineno INTEGER, line TEXT, PRIMARY KEY (job, lineno))')
+        db.execute('CREATE TABLE IF NOT EXISTS web_builds (id TEXT PRIMARY KEY, sid TEXT, state TEXT, owner INTEGER, attempt INTEGER, heartbeat REAL)')
+
+        # worker owning a running job and when it last reported in
+        columns = [row['name'] for row in db.execute('PRAGMA table_info(jobs)')]
+        if 'owner' not in columns:
+            db.execute('ALTER TABLE jobs ADD COLUMN owner INTEGER')
+            db.execute('ALTER TABLE jobs ADD COLUMN heartbeat REAL')
+
+        # counts claims of a job, so results of a requeued run can be told apart
+        if 'attempt' not in columns:
+            db.execute('ALTER TABLE jobs ADD COLUMN attempt INTEGER')
+
+        # builds do not survive a webserver restart
+        db.execute("UPDATE jobs SET status = 'error', error = 'interrupted by webserver restart', plugin = NULL "
+                   "WHERE status = 'building'")
+
+def get_job(db, jobid):
+    row = db.execute('SELECT * FROM jobs WHERE id = ?', (jobid,)).fetchone()
+    return dict(row) if row is not None else None
+
+def get_batch_jobs(db, batch):
+    rows = db.execute('SELECT * FROM jobs WHERE batch = ? ORDER BY seq', (batch,)).fetchall()
+    return [dict(row) for row in rows]
+
+def job_status(job, log=()):
+    return {
+        'id': job['id'],
+        'batch': job['batch'],
+        'bundle': job['bundle'],
+        'device': job['device'],
+        'status': job['status'],
+        'error': job['error'],
+        'artifact': json.loads(job['artifact']) if job['artifact'] else None,
+        'log': list(log),
+    }
+
+def job_finished(job):
+    return job['status'] in ('finished', 'error')
+
+def job_log_path(job):
+    return os.path.join(API_STORAGE, job['batch'], job['bundle'], job['device'])
+
+def job_attempt_path(job, path):
+    # results of a run are written here, and only moved into place if the run still owns the job
+    return f'{path}.{job["attempt"]}.tmp'
+
+def job_claim_update(db, job, sql, params=()):
+    # updates the job only while this run owns it, returns whether it did
+    cursor = db.execute(sql + " WHERE id = ? AND owner = ? AND attempt = ? AND status = 'building'",
+                        tuple(params) + (job['id'], os.getpid(), job['attempt']))
+    return cursor.rowcount == 1
+
+def job_log_lines(db, job, since=0):
+    # logs of finished jobs only exist in the log archive
+    if job_finished(job):
+        path = job_log_path(job)
+        if not os.path.exists(path + '.log.json'):
+            return []
+
+        lines = []
+        for start, chunk in read_log_chunks(path, since):
+            lines.extend(chunk[max(since - start, 0):])
+        return lines
+
+    rows = db.execute('SELECT line FROM job_logs WHERE job = ? AND lineno >= ? ORDER BY lineno', (job['id'], since))
+    return [row['line'] for row in rows]
+
+def job_log_writer(job, lines):
+    # write new log lines in batches, instead of a commit per line, and keep the job heartbeat going
+    flushed = 0
+    heartbeat = time()
+    with closing(sqlite3.connect(STATE_DB, timeout=30)) as db:
+        while True:
+            sleep(0.25)
+            count = len(lines)
+            if count == flushed and time() - heartbeat < JOB_HEARTBEAT_INTERVAL:
+                continue
+            heartbeat = time()
+            with db:
+                # a requeued run must not write into the log of the run that replaced it
+                if not job_claim_update(db, job, 'UPDATE jobs SET heartbeat = ?', (heartbeat,)):
+                    return
+                db.executemany('INSERT INTO job_logs (job, lineno, line) VALUES (?, ?, ?)',
+                               [(job['id'], lineno, lines[lineno]) for lineno in range(flushed, count)])
+            flushed = count
+
+def job_done(job, lines, error, artifact):
+    if error is not None:
+        lines.append(error)
+
+    logpath = job_log_path(job)
+    buildlog = BuildLog(job_attempt_path(job, logpath))
+    for line in lines:
+        buildlog.append(line)
+    buildlog.close()
+
+    results = [(job_attempt_path(job, logpath) + ext, logpath + ext) for ext in ('.log.gz', '.log.json')]
+    if artifact is not None:
+        filename = os.path.join(API_STORAGE, job['batch'], artifact['filename'])
+        results.append((job_attempt_path(job, filename), filename))
+
+    with state_db() as db:
+        db.execute('BEGIN IMMEDIATE')
+
+        owned = job_claim_update(db, job, 'UPDATE jobs SET status = ?, error = ?, artifact = ?, plugin = NULL, owner = NULL',
+                                 ('error' if error is not None else 'finished',
+                                  error,
+                                  json.dumps(artifact) if artifact is not None else None))
+
+        # move results into place before committing, job_log_lines relies on the log archive of finished jobs
+        for tmppath, path in results:
+            if owned:
+                os.rename(tmppath, path)
+            else:
+                os.remove(tmppath)
+
+        if owned:
+            db.execute('DELETE FROM job_logs WHERE job = ?', (job['id'],))
+        else:
+            print('job was requeued, dropping results of this run', job['id'])
+
+def build_job(job, lines):
+    ws, reqid, error = builder_start(targets[job['device']], json.loads(job['plugin']))
+    if error is not None:
+        return error, None
+
+    while True:
+        recv = ws.recv() if ws.connected else None
+        if not recv or not ws.connected:
+            ws.close()
+            return 'server-side build job closed unexpectedly', None
+
+        if recv == '--- END ---':
+            break
+
+        if isinstance(recv, bytes):
+            recv = recv.decode('utf-8', 'replace')
+        lines.append(recv.rstrip('\n'))
+
+    ws.close()
+
+    artifact, error = builder_fetch(targets[job['device']], reqid)
+    if error is not None:
+        return error, None
+
+    if not artifact['size']:
+        return 'build did not produce a bundle', None
+
+    filename = os.path.join(job['bundle'], job['device'] + archive_extensions.get(artifact['compression'], '.tar.gz'))
+    os.makedirs(os.path.join(API_STORAGE, job['batch'], job['bundle']), exist_ok=True)
+
+    with open(job_attempt_path(job, os.path.join(API_STORAGE, job['batch'], filename)), 'wb') as fh:
+        fh.write(artifact.pop('data'))
+
+    artifact['filename'] = filename
+    return None, artifact
+
+def run_job(job):
+    print('job started', job['id'])
+    lines = []
+    writer = spawn(job_log_writer, job, lines)
+
+    try:
+        error, artifact = build_job(job, lines)
+    except Exception as e:
+        error, artifact = f'build job failed: {e}', None
+
+    writer.kill()
+    job_done(job, lines, error, artifact)
+
+def claim_jobs():
+    # pick the oldest queued job of every target that is not busy, workers race for these
+    with state_db() as db:
+        db.execute('BEGIN IMMEDIATE')
+
+        # requeue jobs of workers that died while building
+        stale = time() - JOB_HEARTBEAT_TIMEOUT
+        db.execute("DELETE FROM job_logs WHERE job IN "
+                   "(SELECT id FROM jobs WHERE status = 'building' AND heartbeat < ?)", (stale,))
+        db.execute("UPDATE jobs SET status = 'queued', owner = NULL WHERE status = 'building' AND heartbeat < ?", (stale,))
+
+        rows = db.execute("SELECT * FROM jobs WHERE status = 'queued' AND device NOT IN "
+                          "(SELECT device FROM jobs WHERE status = 'building') ORDER BY created, seq").fetchall()
+
+        claimed = {}
+        for row in rows:
+            if row['device'] not in claimed:
+                claimed[row['device']] = dict(row)
+
+        for job in claimed.values():
+            job['attempt'] = (job['attempt'] or 0) + 1
+            db.execute("UPDATE jobs SET status = 'building', owner = ?, attempt = ?, heartbeat = ? WHERE id = ?",
+                       (os.getpid(), job['attempt'], time(), job['id']))
+
+    return list(claimed.values())
+
+def job_worker():
+    while True:
+        for job in claim_jobs():
+            spawn(run_job, job)
+        for state in claim_web_builds():
+            spawn(run_web_build, state)
+        sleep(1)
+
+@app.route('/api/builds', methods=['POST'])
+def api_builds():
+    data = request.get_json(silent=True)
+    if not data or not isinstance(data.get('plugins', None), list) or not data['plugins']:
+        return { 'ok': False, 'error': 'Missing plugins list' }, 400
+
+    plugins = []
+    bundles = set()
+    for index, msg in enumerate(data['plugins']):
+        if not isinstance(msg, dict):
+            return { 'ok': False, 'index': index, 'error': 'Invalid plugin entry' }, 400
+
+        devices = msg.get('targets', None)
+        if not devices or not isinstance(devices, list) or len(set(devices)) != len(devices):
+            return { 'ok': False, 'index': index, 'error': 'Invalid targets list' }, 400
+
+        for device in devices:
+            if device not in targets:
+                return { 'ok': False, 'index': index, 'error': f'Invalid device target "{device}"' }, 400
+
+        plugin, error = create_package(msg)
+        if error is None:
+            error = validate_plugin(plugin)
+        if error is not None:
+            return { 'ok': False, 'index': index, 'error': error }, 400
+
+        if plugin['bundle'] in bundles:
+            return { 'ok': False, 'index': index, 'error': 'Duplicate plugin bundle in batch' }, 400
+
+        bundles.add(plugin['bundle'])
+        plugins.append((plugin, devices))
+
+    os.makedirs(API_STORAGE, exist_ok=True)
+    batch = os.path.basename(mkdtemp(prefix='', dir=API_STORAGE))
+    created = time()
+    jobids = []
+
+    with state_db() as db:
+        for plugin, devices in plugins:
+            for device in devices:
+                jobid = f'{batch}-{len(jobids)}'
+                db.execute('INSERT INTO jobs (id, batch, seq, bundle, device, status, plugin, created) '
+                           'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                           (jobid, batch, len(jobids), plugin['bundle'], device, 'queued', json.dumps(plugin), created))
+                jobids.append(jobid)
+
+    return { 'ok': True, 'batch': batch, 'jobs': jobids }
+
+@app.route('/api/builds/<batch>', methods=['GET'])
+def api_batch(batch):
+    with state_db() as db:
+        jobs = get_batch_jobs(db, batch)
+    if not jobs:
+        return { 'ok': False, 'error': 'Unknown batch' }, 404
+
+    return { 'ok': True, 'batch': batch, 'jobs': [job_status(job) for job in jobs] }
+
+@app.route('/api/builds/<batch>/download', methods=['GET'])
+def api_batch_download(batch):
+    with state_db() as db:
+        jobs = get_batch_jobs(db, batch)
+    if not jobs:
+        return { 'ok': False, 'error': 'Unknown batch' }, 404
+
+    fh = TemporaryFile()
+    with tarfile.open(fileobj=fh, mode='w') as tar:
+        for job in jobs:
+            if not job['artifact']:
+                continue
+            filename = json.loads(job['artifact'])['filename']
+            tar.add(os.path.join(API_STORAGE, batch, filename), arcname=filename)
+    fh.seek(0)
+
+    return send_file(fh, mimetype='application/x-tar', as_attachment=True, download_name=f'{batch}.tar')
+
+@app.route('/api/jobs/<jobid>', methods=['GET'])
+def api_job(jobid):
+    since = request.args.get('since', 0, type=int)
+    wait = min(request.args.get('wait', 0, type=float), 60)
+
+    with state_db() as db:
+        # long-poll, return as soon as there is something new to report
+        while True:
+            job = get_job(db, jobid)
+            if job is None:
+                return { 'ok': False, 'error': 'Unknown job' }, 404
+            log = job_log_lines(db, job, since)
+            if log or job_finished(job) or wait <= 0:
+                break
+            sleep(0.5)
+            wait -= 0.5
+
+    return { 'ok': True, 'job': job_status(job, log) }
+
+@app.route('/api/jobs/<jobid>/log', methods=['GET'])
+def api_job_log(jobid):
+    with state_db() as db:
+        job = get_job(db, jobid)
+    if job is None or not job_finished(job):
+        return { 'ok': False, 'error': 'Unknown or unfinished job' }, 404
+
+    return read_log(job_log_path(job))
+
+@app.route('/api/logs/<logid>/<device>', methods=['GET'])
+def api_log(logid, device):
+    if not logid.replace('_','').isalnum() or device not in targets:
+        return { 'ok': False, 'error': 'Invalid log id or device' }, 400
+
+    path = os.path.join(LOG_STORAGE, logid, device)
+    if not os.path.exists(path + '.log.json'):
+        return { 'ok': False, 'error': 'Unknown log' }, 404
+
+    return read_log(path)
+
+@app.route('/api/jobs/<jobid>/events', methods=['GET'])
+def api_job_events(jobid):
+    with state_db() as db:
+        job = get_job(db, jobid)
+    if job is None:
+        return { 'ok': False, 'error': 'Unknown job' }, 404
+
+    def events():
+        since = 0
+        with state_db() as db:
+            while True:
+                job = get_job(db, jobid)
+                if job is None:
+                    return
+                finished = job_finished(job)
+                log = job_log_lines(db, job, since)
+                for line in log:
+                    yield f'event: buildlog\ndata: {json.dumps(line)}\n\n'
+                since += len(log)
+                if finished:
+                    break
+                sleep(0.5)
+        yield f'event: status\ndata: {json.dumps(job_status(job))}\n\n'
+
+    return Response(events(), mimetype='text/event-stream')
+
 @app.route('/', methods=['GET'])
 def index():
     return render_template('index.html', builders=builders)
@@ -629,5 +1818,36 @@ def lv2_plugins_featured():
 def pedalboards_stats():
     return {}
 
+def run_worker(server, worker):
+    spawn(job_worker)
+
+    if worker == 0 and BUILDER_STORAGE_RETENTION > 0:
+        spawn(storage_cleanup)
+
+    print(f'Starting worker {worker}...')
+    server.serve_forever()
+
 if __name__ == "__main__":
-    socketio.run(app, host='0.0.0.0', port=8000)
+    state_init()
+
+    # bind once and fork, so all workers accept connections on the same port
+    server = WSGIServer(('0.0.0.0', 8000), app, handler_class=WebSocketHandler)
+    server.init_socket()
+
+    # the main process only supervises workers, restarting them if they die
+    workers = {}
+    while True:
+        for worker in range(WEBSERVER_WORKERS):
+            if worker in workers.values():
+                continue
+
+            pid = os.fork()
+            if pid == 0:
+                run_worker(server, worker)
+                os._exit(0)
+
+            workers[pid] = worker
+
+        pid, status = os.waitpid(-1, 0)
+        print(f'Worker {workers.pop(pid, None)} exited with status {status}, restarting...')
+        sleep(1)